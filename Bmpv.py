@@ -1,5 +1,12 @@
-import subprocess, re, json, requests, tempfile, io, threading, logging, argparse, sys
-from danmaku2ass import ReadCommentsBilibili, ProcessComments
+import subprocess, re, json, requests, tempfile, io, threading, logging, argparse, sys, os, time, itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import multiprocessing
+from danmaku2ass import ReadComments, ProcessComments
+from session import Session
+from throughput import BandwidthStore, select_stream
+from media_cache import MediaCache
+from metadata_cache import MetadataCache, streams_ttl
+from daemon import DEFAULT_SOCKET, serve
 
 if sys.version_info < (3, 7):
     raise RuntimeError('At least Python 3.7 is required')
@@ -12,11 +19,20 @@ if subprocess.run(['which', 'mpv'],
                   stderr=subprocess.DEVNULL).returncode:
     raise RuntimeError('mpv is required in PATH')
 
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'Bmpv')
+
+# Shared by every fetch so per-episode requests reuse warm connections
+session = Session(headers={'User-Agent': 'Mozilla/5.0'})
+bandwidth = BandwidthStore(os.path.join(CACHE_DIR, 'bandwidth.json'))
+metadata = MetadataCache(os.path.join(CACHE_DIR, 'metadata.sqlite3'))
+
 
 class Bmpv:
-    def __init__(self, quality, url):
+    def __init__(self, quality, url, cache=None):
         self.quality = quality
         self.url = url
+        self.cache = cache
         # Init two threads for async tasks
         t_info = threading.Thread(target=self.getInfo)
         t_info.start()
@@ -27,95 +43,227 @@ class Bmpv:
         t_comments.join()
         t_info.join()
 
+        # Auto quality is chosen after getting comments because duration
+        # is required
+        if self.quality == 'auto':
+            quality = select_stream(
+                session, bandwidth, self.info['streams'], self.duration,
+                {'Referer': self.info['extra']['referer']})
+            logging.info(f'Selected quality: {quality}')
+            self.selectSources(quality)
+
+        # Cache entries are keyed by cid
+        if self.cache:
+            self.startDownloads()
+
         # Process after getting video because height is required
         self.processComments()
 
     def getInfo(self):
         logging.info('Start getting video info\n')
-        try:
-            # output = subprocess.check_output(['you-get', '-u', url])[0].decode()
-            # return re.findall("(https:.*)\\n", re.findall("Real URLs:\n(.*)", output, re.S)[0])
-            self.info = json.loads(
-                subprocess.check_output(['you-get', '--json', self.url]))
-            # REF https://github.com/Ylin97/Play-by-mpv/blob/main/play_by_mpv.pys
-            logging.info(
-                f'Available formats: {[_ for _ in self.info["streams"].keys() if "dash" not in _]}'
-            )
-            logging.info('Done getting video info\n')
-        except subprocess.CalledProcessError:
-            logging.error('CalledProcessError')
+        # Stream URLs depend on the login state
+        key = f'{self.url}|{session.cookies_file}'
+        self.info = metadata.get('streams', key)
+        if self.info is None:
+            try:
+                # output = subprocess.check_output(['you-get', '-u', url])[0].decode()
+                # return re.findall("(https:.*)\\n", re.findall("Real URLs:\n(.*)", output, re.S)[0])
+                self.info = json.loads(
+                    subprocess.check_output(['you-get', '--json'] +
+                                            session.you_get_args() +
+                                            [self.url]))
+                # Stream URLs expire, so does their cache entry
+                metadata.put('streams', key, self.info,
+                             streams_ttl(self.info['streams']))
+            except subprocess.CalledProcessError:
+                logging.error('CalledProcessError')
+                return
+        # REF https://github.com/Ylin97/Play-by-mpv/blob/main/play_by_mpv.pys
+        logging.info(
+            f'Available formats: {[_ for _ in self.info["streams"].keys() if "dash" not in _]}'
+        )
+        logging.info('Done getting video info\n')
+        if self.quality != 'auto':
+            self.selectSources(self.quality)
 
+    def selectSources(self, quality):
         # Use best quality available if not defined quality
-        try:
-            self.sources = self.info['streams'][self.quality]['src']
-        except KeyError:
-            self.sources = list(self.info['streams'].values())[0]['src']
+        if quality not in self.info['streams']:
+            quality = list(self.info['streams'])[0]
             logging.warning('Default quality unavailable\n')
+        self.selected = quality
+        self.sources = self.info['streams'][quality]['src']
 
-        # Temporary file as subtitle
-        self.subtitle = tempfile.NamedTemporaryFile(suffix='.ass').name
-        logging.info(f'Temporary .ass file at: {self.subtitle}')
+        if not self.cache:
+            # Temporary file as subtitle
+            self.subtitle = tempfile.NamedTemporaryFile(suffix='.ass').name
+            logging.info(f'Temporary .ass file at: {self.subtitle}')
         self.width, self.height = subprocess.getoutput(
             f'ffprobe -v error -select_streams v:0 -show_entries stream=width,height -of csv=s=x:p=0 "{self.sources[0]}"'
         ).split('x')
         logging.info(f'Width: {self.width}')
         logging.info(f'Height: {self.height}')
 
+    def startDownloads(self):
+        # Start downloading now, so the next episode is prefetched while
+        # the current one plays
+        self.cache_key = f'{self.cid}-{self.selected}'
+        headers = {'Referer': self.info['extra']['referer']}
+        self.downloads = [
+            self.cache.fetch(session, self.cache_key, 'video', self.sources[0],
+                             headers)
+        ]
+        if self.sources[-1] != self.sources[0]:
+            self.downloads.append(
+                self.cache.fetch(session, self.cache_key, 'audio',
+                                 self.sources[-1], headers))
+        self.subtitle = os.path.join(self.cache.entry(self.cache_key),
+                                     'danmaku.ass')
+        logging.info(f'Cached .ass file at: {self.subtitle}')
+
     def getComments(self):
         logging.info('Start getting comments\n')
-        initial_state = json.loads(
-            re.findall(r'__INITIAL_STATE__=(.*?);\(function\(\)',
-                       requests.get(self.url).text)[0])
-        if 'videoData' in initial_state:
-            cid = initial_state['videoData']['pages'][0]['cid']
-        elif 'videoInfo' in initial_state:
-            cid = initial_state['videoInfo']['cid']
-        elif 'epInfo' in initial_state:
-            cid = initial_state['epInfo']['cid']
-        # REF https://github.com/soimort/you-get/blob/a47960f6ed7b2a484b6629678b3a6ad8e39497bd/src/you_get/extractors/bilibili.py#L328
-        xml_url = f'https://comment.bilibili.com/{cid}.xml'
-
-        self.comments_str = re.sub(
-            '[\\x00-\\x08\\x0b\\x0c\\x0e-\\x1f]', '\ufffd',
-            requests.get(xml_url).content.decode('utf-8'))
-
+        self.cid, self.duration = get_video_meta(self.url)
+        self.comments_str = fetch_comments(self.cid)
         logging.info('Done getting comments\n')
 
     def processComments(self):
-        self.comments = list(
-            ReadCommentsBilibili(io.StringIO(self.comments_str),
-                                 fontsize=int(self.height) // 20))
-        self.comments.sort()
-
         with open(self.subtitle,
                   'w',
                   encoding='utf-8-sig',
                   errors='replace',
                   newline='\r\n') as f:
-            ProcessComments(self.comments,
-                            f,
-                            width=int(self.width),
-                            height=int(self.height),
-                            bottomReserved=0,
-                            fontface='sans-serif',
-                            fontsize=int(self.height) // 20,
-                            alpha=1,
-                            duration_marquee=10,
-                            duration_still=5,
-                            filters_regex=[],
-                            reduced=False,
-                            progress_callback=None)
+            self.comments = render_comments(self.comments_str, f,
+                                            int(self.width), int(self.height))
 
     def play(self):
-        subprocess.run([
-            'mpv', '--no-ytdl', self.sources[0],
-            f'--audio-file={self.sources[-1]}',
-            f'--referrer={self.info["extra"]["referer"]}',
-            f'--sub-file={self.subtitle}', '--sid=1'
-        ])
+        video, audio = self.sources[0], self.sources[-1]
+        if self.cache:
+            # Watching counts as use for LRU, and keeps the entry from
+            # being evicted under mpv
+            entry = self.cache.acquire(self.cache_key)
+            # Wait for enough of the head to start playback
+            for download in self.downloads:
+                download.ready.wait()
+            if any(download.size is None and not download.complete
+                   for download in self.downloads):
+                logging.warning('Download failed, streaming instead')
+            else:
+                video = self.cache.source(self.downloads[0])
+                audio = self.cache.source(self.downloads[-1])
+        try:
+            subprocess.run([
+                'mpv', '--no-ytdl', video, f'--audio-file={audio}',
+                f'--referrer={self.info["extra"]["referer"]}',
+                f'--sub-file={self.subtitle}', '--sid=1'
+            ] + session.mpv_args())
+        finally:
+            if self.cache:
+                self.cache.release(entry)
+
+
+def get_video_meta(url, cached=True):
+    meta = metadata.get('video', url) if cached else None
+    if meta is not None:
+        return tuple(meta)
+    initial_state = json.loads(
+        re.findall(r'__INITIAL_STATE__=(.*?);\(function\(\)',
+                   session.get(url).text)[0])
+    duration = None
+    if 'videoData' in initial_state:
+        # Only the first part is played, videoData['duration'] is the
+        # total of all parts
+        cid = initial_state['videoData']['pages'][0]['cid']
+        duration = initial_state['videoData']['pages'][0].get('duration')
+    elif 'videoInfo' in initial_state:
+        cid = initial_state['videoInfo']['cid']
+        duration = initial_state['videoInfo'].get('duration')
+    elif 'epInfo' in initial_state:
+        cid = initial_state['epInfo']['cid']
+        # Milliseconds for bangumi episodes
+        duration = initial_state['epInfo'].get('duration', 0) / 1000
+        cache_season(url, initial_state)
+    else:
+        raise ValueError('No cid in page state')
+    metadata.put('video', url, [cid, duration])
+    return cid, duration
+
+
+def cache_season(url, initial_state):
+    # The page lists every episode of the season, so later episodes and
+    # next_ep skip the scrape
+    if not re.search(r'ep[0-9]+', url):
+        return
+    season = initial_state.get('mediaInfo', {}).get(
+        'season_id') or initial_state.get('ssId')
+    if not season or not initial_state.get('epList'):
+        # Season 0 marks a page listing no episodes, so next_ep does not
+        # scrape it again on every episode change
+        metadata.put('episode', url, 0)
+        return
+    metadata.put('episode', url, season)
+    episodes = []
+    for ep in initial_state.get('epList', []):
+        ep_url = re.sub(r'ep([0-9]*)', f'ep{ep["id"]}', url)
+        episodes.append(ep_url)
+        metadata.put('episode', ep_url, season)
+        metadata.put('video', ep_url,
+                     [ep['cid'], ep.get('duration', 0) / 1000])
+    metadata.put('season', str(season), episodes)
+
+
+def get_cid(url):
+    return get_video_meta(url)[0]
+
+
+def fetch_comments(cid):
+    # REF https://github.com/soimort/you-get/blob/a47960f6ed7b2a484b6629678b3a6ad8e39497bd/src/you_get/extractors/bilibili.py#L328
+    xml_url = f'https://comment.bilibili.com/{cid}.xml'
+    return strip_control_chars(session.get(xml_url).content.decode('utf-8'))
+
+
+def strip_control_chars(comments_str):
+    # Control characters are not allowed in XML and break the parser
+    return re.sub('[\\x00-\\x08\\x0b\\x0c\\x0e-\\x1f]', '\ufffd',
+                  comments_str)
+
+
+def render_comments(comments_str, f, width, height, progress_callback=None):
+    comments = list(
+        ReadComments(io.StringIO(comments_str),
+                     fontsize=height // 20,
+                     input_format='Bilibili'))
+    comments.sort()
+    ProcessComments(comments,
+                    f,
+                    width=width,
+                    height=height,
+                    bottomReserved=0,
+                    fontface='sans-serif',
+                    fontsize=height // 20,
+                    alpha=1,
+                    duration_marquee=10,
+                    duration_still=5,
+                    filters_regex=[],
+                    reduced=False,
+                    progress_callback=progress_callback)
+    return comments
 
 
 def next_ep(url):
+    season = metadata.get('episode', url)
+    if season is None and re.search(r'ep[0-9]+', url):
+        # The episode list expires long before the cid of the episode, so
+        # scrape the page again rather than fall back to guessing
+        try:
+            get_video_meta(url, cached=False)
+        except (requests.RequestException, IndexError, ValueError) as e:
+            logging.warning(f'Failed to refresh episode list: {e}')
+        season = metadata.get('episode', url)
+    episodes = metadata.get('season', str(season)) if season else None
+    if episodes and url in episodes:
+        index = episodes.index(url)
+        return episodes[index + 1] if index + 1 < len(episodes) else None
     try:
         ep_num = int(re.findall(r'ep([0-9]*)', url)[0])
     except IndexError:
@@ -123,28 +271,381 @@ def next_ep(url):
     return re.sub(r'ep([0-9]*)', f'ep{ep_num+1}', url)
 
 
+def clean_url(url):
+    return url.replace('\\', '').split('?')[0]
+
+
+def batch_jobs(inputs):
+    # Each job is (name, kind, source); name is the stem of the .ass output
+    jobs = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for entry in sorted(os.listdir(item)):
+                if entry.endswith('.xml'):
+                    jobs.append((entry[:-len('.xml')], 'xml',
+                                 os.path.join(item, entry)))
+        elif item.isdigit():
+            jobs.append((item, 'cid', item))
+        else:
+            url = clean_url(item)
+            try:
+                name = re.findall(r'(BV[0-9A-Za-z]+|ep[0-9]+)', url)[0]
+            except IndexError:
+                name = re.sub(r'[^0-9A-Za-z]+', '_', url).strip('_')
+            jobs.append((name, 'url', url))
+    return jobs
+
+
+def load_comments(kind, source):
+    if kind == 'xml':
+        with open(source, encoding='utf-8', errors='replace') as f:
+            return strip_control_chars(f.read())
+    if kind == 'url':
+        source = get_cid(source)
+    return fetch_comments(source)
+
+
+def render_job(name, comments_str, path, width, height, progress):
+    def progress_callback(done, total):
+        progress.put((name, done, total))
+
+    # Render into a partial file so an interrupted batch never leaves a
+    # truncated .ass that a resumed run would mistake for a finished one
+    try:
+        with open(path + '.part',
+                  'w',
+                  encoding='utf-8-sig',
+                  errors='replace',
+                  newline='\r\n') as f:
+            render_comments(comments_str, f, width, height, progress_callback)
+    except Exception:
+        if os.path.exists(path + '.part'):
+            os.remove(path + '.part')
+        raise
+    os.replace(path + '.part', path)
+    return name
+
+
+def report_progress(progress, videos):
+    # name -> (done, total) comments, or None once the video failed
+    state = {}
+    while True:
+        update = progress.get()
+        if update is None:
+            return
+        name, done, total = update
+        state[name] = None if done is None else (done, total)
+        rendered = [s for s in state.values() if s is not None]
+        failed = len(state) - len(rendered)
+        # Failed videos count as done, so the count always reaches videos
+        logging.info(
+            f'Rendered {sum(d for d, _ in rendered)}/'
+            f'{sum(t for _, t in rendered)} comments, '
+            f'{sum(d == t for d, t in rendered) + failed}/{videos} videos '
+            f'done ({failed} failed)')
+
+
+def finish_renders(futures, progress):
+    # futures maps each render to the name of its video
+    failed = 0
+    for future in as_completed(futures):
+        name = futures[future]
+        try:
+            future.result()
+            logging.info(f'Done rendering {name}')
+        except Exception as e:
+            logging.error(f'Failed to render {name}: {e}')
+            progress.put((name, None, None))
+            failed += 1
+    return failed
+
+
+def batch(args):
+    os.makedirs(args.output, exist_ok=True)
+    width, height = map(int, args.size.split('x'))
+    pending = []
+    for name, kind, source in batch_jobs(args.inputs):
+        path = os.path.join(args.output, f'{name}.ass')
+        if os.path.exists(path):
+            logging.info(f'Skipping {name}: {path} already exists')
+            continue
+        pending.append((name, kind, source, path))
+    logging.info(f'{len(pending)} videos to render into {args.output}')
+
+    failed = 0
+    # Spawned rather than forked: workers start while fetcher and reporter
+    # threads may hold locks (logging, the session) a fork would copy
+    context = multiprocessing.get_context('spawn')
+    with context.Manager() as manager:
+        progress = manager.Queue()
+        reporter = threading.Thread(target=report_progress, args=(progress, len(pending)))
+        reporter.start()
+        with ThreadPoolExecutor(max_workers=args.max_downloads) as fetchers, \
+                ProcessPoolExecutor(max_workers=args.jobs,
+                                    mp_context=context) as renderers:
+            # Both stages are bounded, so fetched comments never pile up
+            # in memory waiting for a render slot
+            jobs = iter(pending)
+            fetches = {}
+            renders = {}
+            while True:
+                for name, kind, source, path in itertools.islice(
+                        jobs, args.max_downloads - len(fetches)):
+                    fetches[fetchers.submit(load_comments, kind,
+                                            source)] = (name, path)
+                if not fetches:
+                    break
+                done, _ = wait(fetches, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, path = fetches.pop(future)
+                    try:
+                        comments_str = future.result()
+                    except (requests.RequestException, OSError, IndexError,
+                            KeyError, ValueError) as e:
+                        logging.error(
+                            f'Failed to fetch comments of {name}: {e}')
+                        progress.put((name, None, None))
+                        failed += 1
+                        continue
+                    if len(renders) >= 2 * args.jobs:
+                        finished, _ = wait(renders,
+                                           return_when=FIRST_COMPLETED)
+                        failed += finish_renders(
+                            {future: renders.pop(future)
+                             for future in finished}, progress)
+                    renders[renderers.submit(render_job, name, comments_str,
+                                             path, width, height,
+                                             progress)] = name
+            failed += finish_renders(renders, progress)
+        progress.put(None)
+        reporter.join()
+    session.log_stats()
+    metadata.log_stats()
+    if failed:
+        logging.warning(f'{failed} videos failed, rerun to resume')
+    return 1 if failed else 0
+
+
+class Service:
+    '''State the daemon keeps warm between requests: worker threads, and
+    prepared episodes with their info, comments and rendered .ass.'''
+    def __init__(self, workers, cache=None):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.cache = cache
+        self.lock = threading.Lock()
+        # (quality, url) -> future of a prepared Bmpv
+        self.jobs = {}
+        self.running = 0
+        self.playing = 0
+        self.started = time.time()
+
+    def submit(self, quality, url):
+        with self.lock:
+            job = self.jobs.get((quality, url))
+            if job is None or job.done() and (
+                    job.exception() or job.result().expires < time.time()):
+                # Prepared episodes go stale with their stream URLs
+                for key, other in list(self.jobs.items()):
+                    if other.done() and (other.exception() or
+                                         other.result().expires < time.time()):
+                        del self.jobs[key]
+                job = self.pool.submit(self.prepareJob, quality, url)
+                self.jobs[(quality, url)] = job
+            return job
+
+    def prepareJob(self, quality, url):
+        with self.lock:
+            self.running += 1
+        try:
+            bmpv = Bmpv(quality, url, self.cache)
+            bmpv.expires = time.time() + streams_ttl(bmpv.info['streams'])
+            return bmpv
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def playJob(self, bmpv):
+        with self.lock:
+            self.playing += 1
+        try:
+            bmpv.play()
+        finally:
+            with self.lock:
+                self.playing -= 1
+
+    def prepareNext(self, quality, url):
+        # next_ep may scrape the page, so keep it off the reply path
+        url = next_ep(url)
+        if url:
+            self.submit(quality, url)
+
+    def prepare(self, request):
+        self.submit(request['quality'], clean_url(request['url']))
+        return {'ok': True}
+
+    def play(self, request):
+        quality, url = request['quality'], clean_url(request['url'])
+        bmpv = self.submit(quality, url).result()
+        threading.Thread(target=self.playJob, args=(bmpv, ),
+                         daemon=True).start()
+        # At the same time, prepare for next episode
+        threading.Thread(target=self.prepareNext,
+                         args=(quality, url),
+                         daemon=True).start()
+        return {'ok': True}
+
+    def status(self, request):
+        with self.lock:
+            jobs = list(self.jobs.values())
+            running, playing = self.running, self.playing
+        in_flight = sum(not job.done() for job in jobs)
+        return {
+            'ok': True,
+            'uptime': time.time() - self.started,
+            'queued': in_flight - running,
+            'running': running,
+            'prepared': sum(job.done() and not job.exception()
+                            for job in jobs),
+            'failed': sum(job.done() and job.exception() is not None
+                          for job in jobs),
+            'playing': playing,
+            'session': session.stats(),
+            'metadata': metadata.stats()
+        }
+
+
+def daemon(args):
+    service = Service(args.workers, open_cache(args))
+    serve(
+        args.socket, {
+            'prepare': service.prepare,
+            'play': service.play,
+            'status': service.status
+        })
+
+
+def parse_daemon_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='Bmpv.py daemon',
+        description='Serve prepare/play requests from daemon.py clients, '
+        'keeping workers, connections and caches warm.')
+    parser.add_argument('--socket',
+                        default=DEFAULT_SOCKET,
+                        help=f'Unix socket to listen on (default: '
+                        f'{DEFAULT_SOCKET})')
+    parser.add_argument('-w',
+                        '--workers',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Number of prepare workers (default: cores)')
+    add_session_args(parser)
+    add_cache_args(parser)
+    return parser.parse_args(argv)
+
+
+def add_session_args(parser):
+    parser.add_argument('-c',
+                        '--cookies',
+                        metavar='FILE',
+                        help='Netscape cookies.txt, also passed to mpv')
+    parser.add_argument('--http2',
+                        action='store_true',
+                        help='Fetch over HTTP/2, requires httpx[http2]')
+
+
+def add_cache_args(parser):
+    parser.add_argument(
+        '--cache',
+        action='store_true',
+        help='Download video and audio into a local cache before playing')
+    parser.add_argument('--cache-size',
+                        type=float,
+                        default=10,
+                        help='Size limit of the media cache in GiB')
+
+
+def open_cache(args):
+    if args.cache:
+        return MediaCache(os.path.join(CACHE_DIR, 'media'),
+                          int(args.cache_size * (1 << 30)))
+    return None
+
+
+def setup_session(args):
+    if args.cookies:
+        session.load_cookies(args.cookies)
+    if args.http2:
+        session.enable_http2()
+
+
+def parse_batch_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='Bmpv.py batch',
+        description='Render danmaku of many videos into .ass files.')
+    parser.add_argument(
+        'inputs',
+        metavar='INPUT',
+        nargs='+',
+        help='Video URL, cid, or a directory of comment .xml files')
+    parser.add_argument('-o',
+                        '--output',
+                        default='.',
+                        help='Directory to write .ass files into')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Number of render processes (default: cores)')
+    parser.add_argument('--max-downloads',
+                        type=int,
+                        default=4,
+                        help='Maximum number of comment downloads in flight')
+    parser.add_argument('--size',
+                        default='1920x1080',
+                        help='Video resolution to render for, as WxH')
+    add_session_args(parser)
+    return parser.parse_args(argv)
+
+
 def main():
     logging.basicConfig(format='%(levelname)s: %(message)s',
                         level=logging.INFO)
     if len(sys.argv) == 1:
         sys.argv.append('--help')
+    if sys.argv[1] == 'batch':
+        args = parse_batch_args(sys.argv[2:])
+        setup_session(args)
+        sys.exit(batch(args))
+    if sys.argv[1] == 'daemon':
+        args = parse_daemon_args(sys.argv[2:])
+        setup_session(args)
+        sys.exit(daemon(args))
     parser = argparse.ArgumentParser(description='Process some integers.')
     parser.add_argument(
         'quality',
         metavar='Q',
-        help="Quality of the video: ['flv', 'flv720', 'flv480', 'flv360']")
+        help="Quality of the video: ['flv', 'flv720', 'flv480', 'flv360'], "
+        "or 'auto' to pick by measured bandwidth")
     parser.add_argument('url', metavar='URL', help='Video URL')
+    add_session_args(parser)
+    add_cache_args(parser)
     args = parser.parse_args()
+    setup_session(args)
+    cache = open_cache(args)
     url = re.findall(r'(.*)\?', args.url.replace('\\', ''))[0]
     # Start first episode manually
-    bmpv = Bmpv(args.quality, url)
+    bmpv = Bmpv(args.quality, url, cache)
     while url:
         # thread of the current episode
         cur_last = threading.Thread(target=bmpv.play)
         cur_last.start()
         # At the same time, prepare for next episode
         url = next_ep(url)
-        bmpv = Bmpv(args.quality, url)
+        # No next episode at the end of a season
+        if url:
+            bmpv = Bmpv(args.quality, url, cache)
+        session.log_stats()
+        metadata.log_stats()
         # Wait for user to quit mpv
         cur_last.join()
 
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+'''Throughput of every registered comment reader, in comments per second.'''
+import argparse, io, json, random, time
+from danmaku2ass import CommentFormatMap
+
+
+def SampleBilibili(count):
+    return '<?xml version="1.0" encoding="UTF-8"?><i>' + ''.join(
+        f'<d p="{random.uniform(0, 1440):.5f},{random.choice("1145")},25,'
+        f'{random.randint(0, 0xffffff)},0,0,0,{i}">comment {i}</d>'
+        for i in range(count)) + '</i>'
+
+
+def SampleAcfun(count):
+    return json.dumps([[], [], [{
+        'c':
+        f'{random.uniform(0, 1440):.3f},{random.randint(0, 0xffffff)},'
+        f'{random.choice("1245")},25,user,{i}',
+        'm':
+        f'comment {i}'
+    } for i in range(count)]])
+
+
+SampleGenerators = {'Acfun': SampleAcfun, 'Bilibili': SampleBilibili}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n',
+                        '--count',
+                        type=int,
+                        default=200000,
+                        help='Number of synthetic comments per format')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('files',
+                        metavar='FORMAT=FILE',
+                        nargs='*',
+                        help='Benchmark a real file instead of a sample')
+    args = parser.parse_args()
+    samples = {
+        name: generate(args.count)
+        for name, generate in SampleGenerators.items()
+    }
+    for item in args.files:
+        name, path = item.split('=', 1)
+        with open(path, encoding='utf-8', errors='replace') as f:
+            samples[name] = f.read()
+    for name, reader in CommentFormatMap.items():
+        if name not in samples:
+            print(f'{name:>10}: no sample, pass {name}=FILE')
+            continue
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            count = sum(1 for _ in reader(io.StringIO(samples[name]), 25))
+            best = min(best, time.perf_counter() - start)
+        print(f'{name:>10}: {count} comments in {best:.3f}s, '
+              f'{count / best:.0f} comments/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+'''Unix socket plumbing of `Bmpv.py daemon`, and its thin client.
+
+Requests and replies are single JSON lines. The client only needs the
+standard library, so asking a warm daemon to play costs no more than
+starting a bare interpreter:
+
+    python3 daemon.py play <quality> <url>
+    python3 daemon.py status
+'''
+import argparse, json, logging, os, socket, socketserver, sys
+
+DEFAULT_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'),
+                              f'Bmpv-{os.getuid()}.sock')
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            reply = self.server.handlers[request['cmd']](request)
+        except Exception as e:
+            # One bad request must not take the daemon down
+            logging.exception('Failed to handle request')
+            reply = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+def serve(path, handlers):
+    if os.path.exists(path):
+        try:
+            send(path, {'cmd': 'status'}, timeout=5)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # Left behind by a daemon that did not exit cleanly
+            os.remove(path)
+        except socket.timeout:
+            raise RuntimeError(f'Daemon on {path} is not answering, '
+                               'refusing to replace it')
+        else:
+            raise RuntimeError(f'Daemon already listening on {path}')
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    server.daemon_threads = True
+    server.handlers = handlers
+    logging.info(f'Listening on {path}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def send(path, request, timeout=None):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(path)
+        s.sendall(json.dumps(request).encode() + b'\n')
+        return json.loads(s.makefile().readline())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Send a request to a running `Bmpv.py daemon`.')
+    parser.add_argument('cmd', choices=['prepare', 'play', 'status'])
+    parser.add_argument('quality', metavar='Q', nargs='?')
+    parser.add_argument('url', metavar='URL', nargs='?')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET)
+    args = parser.parse_args()
+    if args.cmd != 'status' and not args.url:
+        parser.error(f'{args.cmd} requires Q and URL')
+    try:
+        reply = send(args.socket, {
+            'cmd': args.cmd,
+            'quality': args.quality,
+            'url': args.url
+        })
+    except (ConnectionRefusedError, FileNotFoundError):
+        sys.exit(f'No daemon listening on {args.socket}, '
+                 'start one with `python3 Bmpv.py daemon`')
+    print(json.dumps(reply, indent=2, ensure_ascii=False))
+    sys.exit(0 if reply.get('ok') else 1)
+
+
+if __name__ == '__main__':
+    main()
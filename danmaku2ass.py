@@ -15,16 +15,13 @@ import json
 import logging
 import math
 import random
-import xml.dom.minidom
+import xml.etree.ElementTree
 
 
 def ReadCommentsAcfun(f, fontsize):
-    #comment_element = json.load(f)
-    # after load acfun comment json file as python list, flatten the list
-    #comment_element = [c for sublist in comment_element for c in sublist]
-    comment_elements = json.load(f)
-    comment_element = comment_elements[2]
-    for i, comment in enumerate(comment_element):
+    # Comments are the third element of the top level array, stream them
+    # out one by one instead of loading the whole document
+    for i, comment in enumerate(IterJSONArray(f, (2, ))):
         try:
             p = str(comment['c']).split(',')
             assert len(p) >= 6
@@ -43,24 +40,30 @@ def ReadCommentsAcfun(f, fontsize):
                 c = dict(json.loads(comment['m']))
                 yield (float(p[0]), int(p[5]), i, c, 'acfunpos', int(p[1]),
                        size, 0, 0)
-        except (AssertionError, AttributeError, IndexError, TypeError,
-                ValueError):
-            logging.warning(_('Invalid comment: %r') % comment)
+        except (AssertionError, AttributeError, IndexError, KeyError,
+                TypeError, ValueError):
+            logging.warning('Invalid comment: %r' % comment)
             continue
 
 
 def ReadCommentsBilibili(f, fontsize):
-    dom = xml.dom.minidom.parse(f)
-    comment_element = dom.getElementsByTagName('d')
-    for i, comment in enumerate(comment_element):
+    # iterparse and clearing finished elements keeps memory flat
+    # regardless of how many comments the document holds
+    root = None
+    i = 0
+    for event, comment in xml.etree.ElementTree.iterparse(
+            f, events=('start', 'end')):
+        if root is None:
+            root = comment
+        if event != 'end' or comment.tag != 'd':
+            continue
         try:
-            p = str(comment.getAttribute('p')).split(',')
+            p = str(comment.get('p', '')).split(',')
             assert len(p) >= 5
             assert p[1] in ('1', '4', '5', '6', '7', '8')
-            if comment.childNodes.length > 0:
+            if comment.text is not None:
                 if p[1] in ('1', '4', '5', '6'):
-                    c = str(comment.childNodes[0].wholeText).replace(
-                        '/n', '\n')
+                    c = str(comment.text).replace('/n', '\n')
                     size = int(p[2]) * fontsize / 25.0
                     yield (float(p[0]), int(p[4]), i, c, {
                         '1': 0,
@@ -70,15 +73,101 @@ def ReadCommentsBilibili(f, fontsize):
                     }[p[1]], int(p[3]), size, (c.count('\n') + 1) * size,
                            CalculateLength(c) * size)
                 elif p[1] == '7':  # positioned comment
-                    c = str(comment.childNodes[0].wholeText)
+                    c = str(comment.text)
                     yield (float(p[0]), int(p[4]), i, c, 'bilipos', int(p[3]),
                            int(p[2]), 0, 0)
                 elif p[1] == '8':
                     pass  # ignore scripted comment
         except (AssertionError, AttributeError, IndexError, TypeError,
                 ValueError):
-            logging.warning(_('Invalid comment: %s') % comment.toxml())
+            logging.warning(
+                'Invalid comment: %s' %
+                xml.etree.ElementTree.tostring(comment, encoding='unicode'))
             continue
+        finally:
+            i += 1
+            root.clear()
+
+
+# A reader takes (f, fontsize) and yields comment tuples
+CommentFormatMap = {
+    'Acfun': ReadCommentsAcfun,
+    'Bilibili': ReadCommentsBilibili
+}
+
+
+def RegisterCommentFormat(name, reader):
+    CommentFormatMap[name] = reader
+
+
+def ReadComments(f, fontsize, input_format):
+    try:
+        reader = CommentFormatMap[input_format]
+    except KeyError:
+        raise ValueError('Unknown comment file format: %s' % input_format)
+    return reader(f, fontsize)
+
+
+def IterJSONArray(f, path=(), chunk_size=65536):
+    # Yield the elements of the array found by following the indices in
+    # path from the top level array, reading f in chunks
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+
+    def Peek():
+        nonlocal buf, pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            buf = f.read(chunk_size)
+            pos = 0
+            if not buf:
+                raise ValueError('Unexpected end of JSON')
+
+    def Expect(char):
+        nonlocal pos
+        if Peek() != char:
+            raise ValueError('Expected %r at %r' % (char, buf[pos:pos + 20]))
+        pos += 1
+
+    def Decode():
+        nonlocal buf, pos
+        Peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                end = None
+            # A value ending the buffer may be cut short, e.g. a number
+            if end is None or end == len(buf) or (
+                    not isinstance(value, (str, list, dict))
+                    and buf[end] not in ' \t\r\n,]}'):
+                chunk = f.read(chunk_size)
+                if chunk:
+                    buf = buf[pos:] + chunk
+                    pos = 0
+                    continue
+                if end is None:
+                    raise ValueError('Invalid JSON at %r' % buf[pos:pos + 20])
+            pos = end
+            return value
+
+    Expect('[')
+    for index in path:
+        for _ in range(index):
+            Decode()
+            Expect(',')
+        Expect('[')
+    if Peek() == ']':
+        return
+    while True:
+        yield Decode()
+        if Peek() == ']':
+            return
+        Expect(',')
 
 
 def WriteCommentBilibiliPositioned(f, c, width, height, styleid):
@@ -179,9 +268,9 @@ def WriteCommentBilibiliPositioned(f, c, width, height, styleid):
             })
     except (IndexError, ValueError) as e:
         try:
-            logging.warning(_('Invalid comment: %r') % c[3])
+            logging.warning('Invalid comment: %r' % c[3])
         except IndexError:
-            logging.warning(_('Invalid comment: %r') % c)
+            logging.warning('Invalid comment: %r' % c)
 
 
 def WriteCommentAcfunPositioned(f, c, width, height, styleid):
@@ -333,7 +422,7 @@ def WriteCommentAcfunPositioned(f, c, width, height, styleid):
             FlushCommentLine(f, text, styles, c[0] + from_time,
                              c[0] + from_time + action_time, styleid)
     except (IndexError, ValueError) as e:
-        logging.warning(_('Invalid comment: %r') % c[3])
+        logging.warning('Invalid comment: %r' % c[3])
 
 
 # Result: (f, dx, dy)
@@ -462,7 +551,7 @@ def ProcessComments(comments, f, width, height, bottomReserved, fontface,
         elif i[4] == 'acfunpos':
             WriteCommentAcfunPositioned(f, i, width, height, styleid)
         else:
-            logging.warning(_('Invalid comment: %r') % i[3])
+            logging.warning('Invalid comment: %r' % i[3])
     if progress_callback:
         progress_callback(len(comments), len(comments))
 
@@ -0,0 +1,297 @@
+import http.server, json, logging, os, re, shutil, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+CHUNK_SIZE = 4 << 20
+# Playback starts once this much of the head is on disk
+HEAD_SIZE = 16 << 20
+RETRIES = 3
+
+
+class Download:
+    '''Fetch url into path with several parallel range requests.
+
+    The file is split into CHUNK_SIZE chunks handed out in order, so the
+    head fills first. Finished chunks are recorded in path + '.parts' to
+    resume later; until then read() is the only safe way to the data,
+    since the rest of the file is holes.'''
+    def __init__(self, session, url, path, headers=None, connections=4,
+                 on_done=None):
+        self.session = session
+        self.url = url
+        self.path = path
+        self.headers = dict(headers or {})
+        self.connections = connections
+        self.on_done = on_done
+        self.size = None
+        self.finished = set()
+        # Chunks being fetched, by the pool or by read() on demand
+        self.started = set()
+        self.ready = threading.Event()
+        self.done = threading.Event()
+        self.error = None
+        self.changed = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    @property
+    def complete(self):
+        return self.done.is_set() and os.path.exists(
+            self.path) and not os.path.exists(self.path + '.parts')
+
+    def run(self):
+        try:
+            if os.path.exists(self.path) and not os.path.exists(
+                    self.path + '.parts'):
+                logging.info(f'Cache hit: {self.path}')
+            else:
+                self.fetch()
+        except Exception as e:
+            self.error = e
+            logging.error(f'Failed to download {self.path}: {e}')
+        self.ready.set()
+        self.done.set()
+        if self.on_done:
+            self.on_done()
+
+    def fetch(self):
+        # Streamed, so a server ignoring Range sends the file only once
+        with self.session.stream(self.url,
+                                 headers=dict(self.headers,
+                                              Range='bytes=0-0'),
+                                 timeout=10) as (response, chunks):
+            try:
+                size = int(response.headers['Content-Range'].split('/')[-1])
+            except (KeyError, ValueError):
+                if response.status_code != 200:
+                    raise IOError(f'HTTP {response.status_code}')
+                # No range support, the reply is the whole file
+                logging.warning(f'No range support, downloading {self.url}')
+                with open(self.path + '.tmp', 'wb') as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+                os.replace(self.path + '.tmp', self.path)
+                return
+        try:
+            with open(self.path + '.parts') as f:
+                finished = set(json.load(f))
+        except (OSError, ValueError):
+            finished = set()
+            # Written before the file so a crash never looks like a hit
+            with open(self.path + '.parts', 'w') as f:
+                json.dump([], f)
+        if not os.path.exists(self.path):
+            with open(self.path, 'wb') as f:
+                f.truncate(size)
+        with self.changed:
+            self.finished = finished
+            self.chunks = range(0, size, CHUNK_SIZE)
+            self.size = size
+        self.checkReady()
+        logging.info(f'Downloading {size >> 20} MiB into {self.path} '
+                     f'({len(finished)}/{len(self.chunks)} chunks cached)')
+        with ThreadPoolExecutor(max_workers=self.connections) as pool:
+            for _ in pool.map(self.fetchChunk, self.chunks):
+                pass
+
+    def fetchChunk(self, start):
+        with self.changed:
+            if start in self.finished or start in self.started:
+                return
+            self.started.add(start)
+        end = min(start + CHUNK_SIZE, self.size) - 1
+        for attempt in range(RETRIES):
+            try:
+                content = self.session.get(
+                    self.url,
+                    headers=dict(self.headers, Range=f'bytes={start}-{end}'),
+                    timeout=30).content
+                if len(content) != end - start + 1:
+                    raise IOError(
+                        f'Short read at {start}: {len(content)} bytes')
+                break
+            except IOError as e:
+                # requests.RequestException is an IOError too
+                logging.warning(f'Chunk {start} of {self.path} failed '
+                                f'({attempt + 1}/{RETRIES}): {e}')
+                if attempt == RETRIES - 1:
+                    with self.changed:
+                        self.started.discard(start)
+                        self.changed.notify_all()
+                    # read() fetches the chunk on demand from here on,
+                    # so there is no reason to hold playback back
+                    self.ready.set()
+                    raise
+                time.sleep(attempt + 1)
+        with self.changed:
+            with open(self.path, 'r+b') as f:
+                f.seek(start)
+                f.write(content)
+            self.finished.add(start)
+            self.started.discard(start)
+            if len(self.finished) == len(self.chunks):
+                os.remove(self.path + '.parts')
+            else:
+                with open(self.path + '.parts', 'w') as parts:
+                    json.dump(sorted(self.finished), parts)
+            self.changed.notify_all()
+        self.checkReady()
+
+    def checkReady(self):
+        with self.changed:
+            if all(start in self.finished
+                   for start in range(0, min(HEAD_SIZE, self.size),
+                                      CHUNK_SIZE)):
+                self.ready.set()
+
+    def read(self, start, end):
+        '''Bytes from start to end or the end of its chunk, blocking until
+        the chunk is on disk. A chunk nobody is fetching, because it is
+        far ahead after a seek or the download gave up on it, is fetched
+        right here.'''
+        chunk = start - start % CHUNK_SIZE
+        while True:
+            with self.changed:
+                if chunk in self.finished:
+                    break
+                if chunk in self.started:
+                    self.changed.wait()
+                    continue
+            self.fetchChunk(chunk)
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            return f.read(min(end, chunk + CHUNK_SIZE - 1) - start + 1)
+
+
+class MediaHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        download = self.server.downloads.get(self.path.lstrip('/'))
+        if download is None:
+            self.send_error(404)
+            return
+        size = download.size
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), size - 1)
+            elif match.group(2):
+                start = max(size - int(match.group(2)), 0)
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        try:
+            while start <= end:
+                content = download.read(start, end)
+                self.wfile.write(content)
+                start += len(content)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # mpv seeked elsewhere and dropped this request
+        except IOError as e:
+            # Closing early makes mpv retry the range
+            logging.error(f'Failed to serve {download.path}: {e}')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def entry_size(path):
+    # Downloads drop .parts and rename .tmp files without the cache lock
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+class MediaCache:
+    '''Downloaded streams and rendered .ass, one directory per video,
+    evicted least recently used first once over max_size bytes.'''
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        os.makedirs(root, exist_ok=True)
+        self.lock = threading.Lock()
+        # Entry -> number of downloads and players using it
+        self.in_use = {}
+        self.server = None
+
+    def entry(self, key):
+        return os.path.join(self.root, re.sub(r'[^0-9A-Za-z.-]+', '_', key))
+
+    def acquire(self, key):
+        '''Entry of key, kept from eviction until release().'''
+        path = self.entry(key)
+        with self.lock:
+            os.makedirs(path, exist_ok=True)
+            # Directory mtime is the LRU timestamp
+            os.utime(path)
+            self.in_use[path] = self.in_use.get(path, 0) + 1
+        return path
+
+    def release(self, path):
+        with self.lock:
+            self.in_use[path] -= 1
+            if not self.in_use[path]:
+                del self.in_use[path]
+
+    def fetch(self, session, key, name, url, headers=None):
+        '''Start downloading url as name in the entry of key.'''
+        ext = os.path.splitext(urlsplit(url).path)[1]
+        entry = self.acquire(key)
+        self.evict()
+        return Download(session,
+                        url,
+                        os.path.join(entry, name + ext),
+                        headers,
+                        on_done=lambda: self.release(entry))
+
+    def source(self, download):
+        '''What to hand mpv for download: the file once complete, else a
+        local URL that blocks on chunks not downloaded yet.'''
+        if download.complete:
+            return download.path
+        with self.lock:
+            if self.server is None:
+                self.server = http.server.ThreadingHTTPServer(
+                    ('127.0.0.1', 0), MediaHandler)
+                self.server.daemon_threads = True
+                self.server.downloads = {}
+                threading.Thread(target=self.server.serve_forever,
+                                 daemon=True).start()
+            name = f'{len(self.server.downloads)}' + os.path.splitext(
+                download.path)[1]
+            self.server.downloads[name] = download
+        return f'http://127.0.0.1:{self.server.server_port}/{name}'
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.root):
+                path = os.path.join(self.root, name)
+                try:
+                    size = sum(
+                        entry_size(os.path.join(path, f))
+                        for f in os.listdir(path))
+                    entries.append((os.path.getmtime(path), size, path))
+                except FileNotFoundError:
+                    continue
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                if path in self.in_use:
+                    continue
+                logging.info(f'Evicting {path} from media cache')
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
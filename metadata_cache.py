@@ -0,0 +1,84 @@
+import json, logging, os, sqlite3, threading, time
+from urllib.parse import parse_qs, urlsplit
+
+# Seconds a cached value stays valid, per kind
+TTL = {
+    'video': 30 * 24 * 3600,  # URL -> cid never changes
+    'season': 24 * 3600,  # New episodes get added to the list
+    'episode': 24 * 3600,
+    'streams': 600,  # Only when the URLs carry no deadline
+}
+# Drop stream info this long before the URLs in it expire
+EXPIRY_MARGIN = 60
+
+
+class MetadataCache:
+    '''SQLite store of metadata that is slow to scrape, with expiry.'''
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS metadata ('
+                        'kind TEXT, key TEXT, value TEXT, expires REAL, '
+                        'PRIMARY KEY (kind, key))')
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+        self.purge()
+
+    def get(self, kind, key):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT value FROM metadata '
+                'WHERE kind = ? AND key = ? AND expires > ?',
+                (kind, key, time.time())).fetchone()
+            counter = self.misses if row is None else self.hits
+            counter[kind] = counter.get(kind, 0) + 1
+        return None if row is None else json.loads(row[0])
+
+    def put(self, kind, key, value, ttl=None):
+        if ttl is None:
+            ttl = TTL[kind]
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)',
+                (kind, key, json.dumps(value), time.time() + ttl))
+            self.db.commit()
+
+    def purge(self):
+        with self.lock:
+            self.db.execute('DELETE FROM metadata WHERE expires <= ?',
+                            (time.time(), ))
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            return {
+                kind: {
+                    'hits': self.hits.get(kind, 0),
+                    'misses': self.misses.get(kind, 0)
+                }
+                for kind in sorted(set(self.hits) | set(self.misses))
+            }
+
+    def log_stats(self):
+        for kind, stat in self.stats().items():
+            logging.info(f'Metadata cache {kind}: {stat["hits"]} hits, '
+                         f'{stat["misses"]} misses')
+
+
+def streams_ttl(streams):
+    '''Time until the earliest deadline of the stream URLs.'''
+    deadlines = []
+    for stream in streams.values():
+        for src in stream.get('src', []):
+            # DASH streams nest one list of segments per track
+            for url in src if isinstance(src, list) else [src]:
+                try:
+                    deadlines.append(
+                        int(parse_qs(urlsplit(url).query)['deadline'][0]))
+                except (KeyError, ValueError):
+                    pass
+    if not deadlines:
+        return TTL['streams']
+    return max(min(deadlines) - time.time() - EXPIRY_MARGIN, 0)
@@ -0,0 +1,157 @@
+import contextlib, http.cookiejar, logging, threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+
+# HTTP/2 is only available through httpx with the h2 extra installed
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class Session:
+    '''One HTTP session shared by every fetch, so repeated requests to the
+    same host reuse warm connections instead of a new handshake each time.'''
+    def __init__(self, pool_maxsize=10, headers=None):
+        self.pool_maxsize = pool_maxsize
+        self.cookies_file = None
+        self.client = requests.Session()
+        # urllib3 keeps one connection pool per host
+        adapter = HTTPAdapter(pool_connections=pool_maxsize,
+                              pool_maxsize=pool_maxsize)
+        self.client.mount('http://', adapter)
+        self.client.mount('https://', adapter)
+        # Only advertises br when brotli is installed to decode it
+        self.client.headers['Accept-Encoding'] = ACCEPT_ENCODING
+        self.extra_headers = dict(headers or {})
+        self.client.headers.update(self.extra_headers)
+        self.http2 = None
+        self.lock = threading.Lock()
+        self.requests = {}
+        # Connections opened by the HTTP/2 client, which has no public pool
+        # stats, counted through its trace hook
+        self.opened = {}
+
+    @property
+    def headers(self):
+        return self.client.headers
+
+    def load_cookies(self, path):
+        jar = http.cookiejar.MozillaCookieJar(path)
+        jar.load(ignore_discard=True, ignore_expires=True)
+        self.client.cookies.update(jar)
+        self.cookies_file = path
+        logging.info(f'Loaded {len(jar)} cookies from {path}')
+
+    def enable_http2(self):
+        try:
+            self.http2 = httpx.Client(http2=True,
+                                      headers=dict(self.client.headers),
+                                      cookies=self.client.cookies,
+                                      follow_redirects=True,
+                                      limits=httpx.Limits(
+                                          max_connections=self.pool_maxsize))
+        except (AttributeError, ImportError):
+            # AttributeError: httpx missing; ImportError: h2 missing
+            logging.warning('HTTP/2 requires httpx[http2], using HTTP/1.1')
+
+    def count(self, url):
+        host = urlsplit(url).hostname
+        with self.lock:
+            self.requests[host] = self.requests.get(host, 0) + 1
+
+    def trace(self, event, info):
+        if event == 'connection.connect_tcp.started':
+            with self.lock:
+                self.opened[info['host']] = self.opened.get(info['host'],
+                                                            0) + 1
+
+    def get(self, url, **kwargs):
+        self.count(url)
+        if self.http2 is None:
+            return self.client.get(url, **kwargs)
+        try:
+            response = self.http2.get(url,
+                                      extensions={'trace': self.trace},
+                                      **kwargs)
+        except httpx.HTTPError as e:
+            # Keep a single exception type for callers
+            raise requests.ConnectionError(e)
+        return response
+
+    @contextlib.contextmanager
+    def stream(self, url, **kwargs):
+        '''Response of url with the body left unread, and an iterator over
+        the body in chunks.'''
+        self.count(url)
+        if self.http2 is None:
+            with self.client.get(url, stream=True, **kwargs) as response:
+                yield response, response.iter_content(1 << 16)
+            return
+        try:
+            with self.http2.stream('GET',
+                                   url,
+                                   extensions={'trace': self.trace},
+                                   **kwargs) as response:
+                yield response, response.iter_bytes(1 << 16)
+        except httpx.HTTPError as e:
+            raise requests.ConnectionError(e)
+
+    def read_head(self, url, nbytes, **kwargs):
+        '''Status code and at most the first nbytes of the body, without
+        downloading the rest even if the server ignores Range.'''
+        content = bytearray()
+        with self.stream(url, **kwargs) as (response, chunks):
+            for chunk in chunks:
+                content += chunk
+                if len(content) >= nbytes:
+                    break
+            return response.status_code, bytes(content[:nbytes])
+
+    def stats(self):
+        '''Per host request count, new connections opened and pool hits.'''
+        with self.lock:
+            counts = dict(self.requests)
+            connections = dict(self.opened)
+        if self.http2 is None:
+            for adapter in set(self.client.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        connections[pool.host] = connections.get(
+                            pool.host, 0) + pool.num_connections
+        return {
+            host: {
+                'requests': count,
+                'connections': connections.get(host, 0),
+                'hits': count - connections.get(host, 0)
+            }
+            for host, count in counts.items()
+        }
+
+    def log_stats(self):
+        for host, stat in self.stats().items():
+            logging.info(f'{host}: {stat["requests"]} requests, '
+                         f'{stat["connections"]} connections, '
+                         f'{stat["hits"]} pool hits')
+
+    def mpv_args(self):
+        '''Forward the same cookies and headers to mpv.'''
+        args = []
+        fields = []
+        for name, value in self.extra_headers.items():
+            if name.lower() == 'user-agent':
+                args.append(f'--user-agent={value}')
+            else:
+                fields.append(f'{name}: {value}')
+        if fields:
+            args.append(f'--http-header-fields={",".join(fields)}')
+        if self.cookies_file:
+            args += ['--cookies', f'--cookies-file={self.cookies_file}']
+        return args
+
+    def you_get_args(self):
+        return ['--cookies', self.cookies_file] if self.cookies_file else []
@@ -0,0 +1,90 @@
+import json, logging, os, tempfile, threading, time
+import requests
+from urllib.parse import urlsplit
+
+# Only pick streams using at most this fraction of the measured bandwidth
+SAFETY_MARGIN = 0.8
+PROBE_BYTES = 1 << 20
+# Expired estimates older than this many TTLs are too stale to smooth with,
+# the network may well have changed since
+SMOOTHING_TTLS = 4
+
+
+class BandwidthStore:
+    '''Per CDN host bandwidth estimates persisted across episodes, so later
+    episodes from the same host skip the probe.'''
+    def __init__(self, path, ttl=3600):
+        self.path = path
+        self.ttl = ttl
+        # Daemon workers probe and store concurrently
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.estimates = json.load(f)
+        except (OSError, ValueError):
+            self.estimates = {}
+
+    def get(self, host):
+        with self.lock:
+            estimate = self.estimates.get(host)
+        if estimate and time.time() - estimate['time'] < self.ttl:
+            return estimate['bps']
+        return None
+
+    def put(self, host, bps):
+        # Smooth with a recently expired estimate so one slow probe does
+        # not drag the quality down for the rest of the series
+        with self.lock:
+            previous = self.estimates.get(host)
+            if previous is not None and time.time(
+            ) - previous['time'] < SMOOTHING_TTLS * self.ttl:
+                bps = (previous['bps'] + bps) / 2
+            self.estimates[host] = {'bps': bps, 'time': time.time()}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with tempfile.NamedTemporaryFile('w',
+                                             dir=os.path.dirname(self.path),
+                                             delete=False) as f:
+                json.dump(self.estimates, f)
+            os.replace(f.name, self.path)
+        return bps
+
+
+def probe(session, url, headers=None, nbytes=PROBE_BYTES):
+    '''Time a ranged read of the head of url, returns bits per second.'''
+    headers = dict(headers or {}, Range=f'bytes=0-{nbytes - 1}')
+    start = time.monotonic()
+    # A 200 means Range was ignored, read_head still stops after nbytes
+    status, content = session.read_head(url, nbytes, headers=headers,
+                                        timeout=10)
+    if status not in (200, 206):
+        raise requests.HTTPError(f'HTTP {status} from {url}')
+    return len(content) * 8 / max(time.monotonic() - start, 1e-3)
+
+
+def select_stream(session, store, streams, duration, headers=None):
+    '''Key of the largest stream whose bitrate fits the bandwidth of its
+    host under SAFETY_MARGIN, or of the smallest one if none fits.'''
+    candidates = sorted(
+        (key for key, stream in streams.items()
+         if stream.get('size') and 'dash' not in key),
+        key=lambda key: streams[key]['size'],
+        reverse=True)
+    if not candidates or not duration:
+        return None
+    for key in candidates:
+        url = streams[key]['src'][0]
+        host = urlsplit(url).hostname
+        bps = store.get(host)
+        if bps is None:
+            try:
+                measured = probe(session, url, headers)
+            except requests.RequestException as e:
+                logging.warning(f'Throughput probe of {host} failed: {e}')
+                continue
+            bps = store.put(host, measured)
+            logging.info(f'Measured {measured / 1e6:.1f} Mbps from {host}, '
+                         f'estimating {bps / 1e6:.1f} Mbps')
+        bitrate = streams[key]['size'] * 8 / duration
+        if bitrate <= bps * SAFETY_MARGIN:
+            return key
+    return candidates[-1]